@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
 import fnmatch
 import functools
-import glob
+import hashlib
+import operator
 import os
 import re
 import subprocess
 import sys
 import textwrap
+import threading
 from dataclasses import dataclass
 from typing import Callable, Optional
 
@@ -16,32 +19,42 @@ class InvalidArgument(Exception):
     pass
 
 
-@functools.total_ordering
-class Version:
+# _Version._parse()のループ内から呼び出すため、モジュール読み込み時にコンパイルしておく。
+_COMPONENT_FULLMATCH = re.compile(r'(\d*)(.*)').fullmatch
+# '2.7.x'のような、前方一致で判定できる単純なバージョンパターンを検出する。
+_SIMPLE_PATTERN_FULLMATCH = re.compile(r'(\d+\.)+x').fullmatch
+
+
+class _Version:
+    # __dict__を持たせないことで、インスタンスあたりのメモリと属性参照のコストを削減する。
+    __slots__ = ('version', 'components', '_hash')
+
     def __init__(self, version: str):
         self.version = version
         self.components = tuple(self._parse(version))
+        self._hash = hash(self.components)
 
     @classmethod
     def _parse(self, version: str):
         """
-        >>> tuple(Version._parse('1.2'))
+        >>> tuple(_Version._parse('1.2'))
         ((1, ''), (2, ''))
-        >>> tuple(Version._parse('1.2-rc'))
+        >>> tuple(_Version._parse('1.2-rc'))
         ((1, ''), (2, '-rc'))
-        >>> tuple(Version._parse('1.beta'))
+        >>> tuple(_Version._parse('1.beta'))
         ((1, ''), (0, 'beta'))
         """
         components = version.split('.')
         for c in components:
-            try:
+            if c.isdigit():
+                # ほとんどのコンポーネントは数値のみなので、例外処理を経由せずに変換する。
                 yield int(c), ''
-            except ValueError:
-                result = re.fullmatch(r'(\d*)(.*)', c)
-                # 数値部分が存在しない場合、数値部分として扱う。
-                integer = result.group(1) or '0'
-                string = result.group(2)
-                yield int(integer), string
+                continue
+            result = _COMPONENT_FULLMATCH(c)
+            # 数値部分が存在しない場合、数値部分として扱う。
+            integer = result.group(1) or '0'
+            string = result.group(2)
+            yield int(integer), string
 
     def __str__(self):
         return self.version
@@ -57,6 +70,29 @@ class Version:
         """
         return self.components < other.components
 
+    def __le__(self, other: 'Version') -> bool:
+        """
+        >>> Version('1.0') <= Version('1.0')
+        True
+        >>> Version('1.1') <= Version('1.0')
+        False
+        """
+        return self.components <= other.components
+
+    def __gt__(self, other: 'Version') -> bool:
+        """
+        >>> Version('0.10') > Version('0.9')
+        True
+        """
+        return self.components > other.components
+
+    def __ge__(self, other: 'Version') -> bool:
+        """
+        >>> Version('1.0') >= Version('1.0')
+        True
+        """
+        return self.components >= other.components
+
     def __eq__(self, other: 'Version') -> bool:
         """
         >>> Version('1.2') == Version('01.02')
@@ -64,8 +100,28 @@ class Version:
         """
         return self.components == other.components
 
+    def __ne__(self, other: 'Version') -> bool:
+        """
+        >>> Version('1.2') != Version('1.3')
+        True
+        """
+        return self.components != other.components
+
+    def __hash__(self):
+        """
+        >>> hash(Version('1.2')) == hash(Version('01.02'))
+        True
+        """
+        return self._hash
+
+
+@functools.lru_cache(maxsize=1024)
+def Version(version: str) -> '_Version':
+    # 同じバージョン文字列が何度もパースされるため、生成済みのインスタンスを再利用する。
+    return _Version(version)
 
-class MinVersionMatcher:
+
+class _MinVersionMatcher:
     def __init__(self, version: str):
         self.version = Version(version)
 
@@ -81,7 +137,12 @@ class MinVersionMatcher:
         return self.version <= ver
 
 
-class MaxVersionMatcher:
+@functools.lru_cache(maxsize=None)
+def MinVersionMatcher(version: str) -> '_MinVersionMatcher':
+    return _MinVersionMatcher(version)
+
+
+class _MaxVersionMatcher:
     def __init__(self, version: str):
         self.version = Version(version)
 
@@ -97,20 +158,25 @@ class MaxVersionMatcher:
         return ver < self.version
 
 
-class MultiVersionMatcher:
+@functools.lru_cache(maxsize=None)
+def MaxVersionMatcher(version: str) -> '_MaxVersionMatcher':
+    return _MaxVersionMatcher(version)
+
+
+class _MultiVersionMatcher:
     def __init__(self, version_pattern: str):
         self._matcher = self._make_matcher(version_pattern)
 
     @classmethod
     def _make_matcher(cls, pattern: str) -> Callable[[Version], bool]:
         """
-        >>> MultiVersionMatcher._make_matcher('1.x')('0.0.0')
+        >>> _MultiVersionMatcher._make_matcher('1.x')('0.0.0')
         False
-        >>> MultiVersionMatcher._make_matcher('1.x')('1.0')
+        >>> _MultiVersionMatcher._make_matcher('1.x')('1.0')
         True
-        >>> MultiVersionMatcher._make_matcher('1.x')('1.2.3')
+        >>> _MultiVersionMatcher._make_matcher('1.x')('1.2.3')
         True
-        >>> MultiVersionMatcher._make_matcher('1.x')('1.3-rc1')
+        >>> _MultiVersionMatcher._make_matcher('1.x')('1.3-rc1')
         True
         """
         if ',' in pattern or '.' in pattern:
@@ -119,16 +185,37 @@ class MultiVersionMatcher:
             patterns = [pattern.strip()]
 
         matchers = []
+        regexps = []
         for p in patterns:
+            if _SIMPLE_PATTERN_FULLMATCH(p):
+                # '2.7.x'のような単純なパターンは、正規表現を使わずに前方一致で判定できる。
+                # 'x'はglobの'?*'に相当するため、プレフィックスに1文字以上続けば一致とする。
+                prefix = p[:-1]
+                matchers.append(
+                    lambda version, _p=prefix, _n=len(prefix):
+                    version.startswith(_p) and len(version) > _n)
+                continue
             glob_pattern = p.replace('x', '?*')
-            regexp = fnmatch.translate(glob_pattern)
-            matcher = re.compile(regexp).fullmatch
-            matchers.append(matcher)
+            regexps.append('(?:%s)' % fnmatch.translate(glob_pattern))
+
+        if regexps:
+            # N個の正規表現をany()で順に試す代わりに、1個に結合してreの呼び出しを1回にする。
+            # 各要素に含まれる\Zはfullmatch()と同等の意味のため、結合しても問題ない。
+            fullmatch = re.compile('|'.join(regexps)).fullmatch
+            matchers.append(lambda version, _fullmatch=fullmatch: _fullmatch(version) is not None)
 
-        return lambda version: any(m(version) for m in matchers)
+        if len(matchers) == 1:
+            return matchers[0]
+        return lambda version, _ms=tuple(matchers): any(m(version) for m in _ms)
 
     def match(self, ver: Version) -> bool:
-        return self._matcher(str(ver))
+        # str(ver)はver.versionを返すだけなので、メソッドディスパッチを省略して直接参照する。
+        return self._matcher(ver.version)
+
+
+@functools.lru_cache(maxsize=None)
+def MultiVersionMatcher(version_pattern: str) -> '_MultiVersionMatcher':
+    return _MultiVersionMatcher(version_pattern)
 
 
 class NullVersionMatcher:
@@ -136,11 +223,93 @@ class NullVersionMatcher:
         return True
 
 
+def _match_any_version(ver: Version) -> bool:
+    return True
+
+
+def build_combined_matcher(min_matcher, max_matcher, multi_matcher) -> Callable[[Version], bool]:
+    """3つのmatcherを1つの述語に合成する。
+
+    >>> m = build_combined_matcher(
+    ...     MinVersionMatcher('1.0'), MaxVersionMatcher('2.0'), NullVersionMatcher())
+    >>> m(Version('0.9'))
+    False
+    >>> m(Version('1.5'))
+    True
+    >>> m(Version('2.0'))
+    False
+    >>> build_combined_matcher(
+    ...     NullVersionMatcher(), NullVersionMatcher(), NullVersionMatcher())(Version('1.0'))
+    True
+    """
+    # 常にTrueを返すNullVersionMatcherは、合成する前に取り除く。
+    matchers = [m for m in (min_matcher, max_matcher, multi_matcher)
+                if not isinstance(m, NullVersionMatcher)]
+    if not matchers:
+        return _match_any_version
+    if len(matchers) == 1:
+        return matchers[0].match
+    # boundメソッドをデフォルト引数に束縛し、呼び出しごとの属性参照を省略する。
+    if len(matchers) == 2:
+        a, b = matchers
+        return lambda ver, _a=a.match, _b=b.match: _a(ver) and _b(ver)
+    a, b, c = matchers
+    return lambda ver, _a=a.match, _b=b.match, _c=c.match: \
+        _a(ver) and _b(ver) and _c(ver)
+
+
+# サブプロセス用の環境変数dictの再利用領域。ThreadPoolExecutorから並行に呼ばれるため、
+# スレッドごとに分ける。
+_ENV_SCRATCH = threading.local()
+
+
+def _reuse_env(base_env: Optional[dict], path: Optional[str]) -> dict:
+    # subprocessはspawn時にenvの内容をコピーするため、呼び出し間で同じdictを再利用して
+    # PATHだけを書き換えれば良い。環境変数全体のコピーは1スレッドにつき1回で済む。
+    if base_env is None:
+        # base_envが与えられない場合は再利用せず、従来どおり使い捨てのコピーを作る。
+        env = dict(os.environ)
+    elif getattr(_ENV_SCRATCH, 'base', None) is not base_env:
+        _ENV_SCRATCH.base = base_env
+        _ENV_SCRATCH.env = env = base_env.copy()
+    else:
+        env = _ENV_SCRATCH.env
+
+    if path is not None:
+        env['PATH'] = path
+        return env
+    # 前回の呼び出しで書き換えたPATHが残っていることがあるため、ベースの値に戻す。
+    base = base_env if base_env is not None else os.environ
+    orig = base.get('PATH')
+    if orig is None:
+        env.pop('PATH', None)
+    else:
+        env['PATH'] = orig
+    return env
+
+
+def _run_streaming(cmd, shell: bool, env: dict) -> str:
+    # subprocess.run()の代わりにPopenで逐次読み取ることで、プロセスの終了を
+    # 待たずに出力をチャンク単位で回収し、最後に1回だけ結合する。
+    proc = subprocess.Popen(cmd, shell=shell,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            env=env,
+                            encoding='utf8')
+    chunks = []
+    with proc:
+        for line in proc.stdout:
+            chunks.append(line)
+    out = ''.join(chunks)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output=out)
+    return out
+
+
 class ShellCommand:
     def __init__(self, cmd: str):
         self.cmd = cmd
 
-    def run(self, py: Optional['PythonInterpreter'] = None):
+    def run(self, py: Optional['PythonInterpreter'] = None, base_env: Optional[dict] = None):
         r""" Run the shell commands.
 
         >>> ShellCommand('echo OK').run()
@@ -152,18 +321,12 @@ class ShellCommand:
         >>> ShellCommand('echo stderr >&2').run()
         'stderr\n'
         """
-        new_env = {**os.environ}
-        if py:
-            new_env['PATH'] = py.bin_dir + ':' + new_env.get('PATH', '')
-        result = subprocess.run(self.cmd, shell=True, check=True,
-                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                                env=new_env,
-                                encoding='utf8')
-        return result.stdout
+        new_env = _reuse_env(base_env, py.path_env if py else None)
+        return _run_streaming(self.cmd, shell=True, env=new_env)
 
 
 class NullShellCommand:
-    def run(self):
+    def run(self, py: Optional['PythonInterpreter'] = None, base_env: Optional[dict] = None):
         return ''
 
 
@@ -171,14 +334,9 @@ class PythonCommand:
     def __init__(self, args):
         self.args = args
 
-    def run(self, py: 'PythonInterpreter'):
-        new_env = {**os.environ}
-        new_env['PATH'] = py.bin_dir + ':' + new_env.get('PATH', '')
-        result = subprocess.run(['python', *self.args], check=True,
-                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                                env=new_env,
-                                encoding='utf8')
-        return result.stdout
+    def run(self, py: 'PythonInterpreter', base_env: Optional[dict] = None):
+        new_env = _reuse_env(base_env, py.path_env)
+        return _run_streaming(['python', *self.args], shell=False, env=new_env)
 
 
 @dataclass
@@ -186,36 +344,70 @@ class PythonInterpreter:
     binary_path: str
     bin_dir: str
     version: Version
+    # このインタプリタを実行するときの$PATH。発見時に一度だけ組み立てる。
+    path_env: str
 
 
 class PythonRepository:
     def __init__(self, prefix):
         self.prefix = prefix
+        self._all = None
 
     def find(self, matcher: Callable[[Version], bool]):
         for py in self.find_all():
             if matcher(py.version):
                 yield py
 
+    def sorted_find(self, matcher: Callable[[Version], bool]):
+        # find_all()はソート済みのリストを返すため、フィルタするだけで良い。
+        return [py for py in self.find_all() if matcher(py.version)]
+
     def find_all(self):
-        yield from self.find_all_cpython()
-        # yield from self.find_all_pypy()
+        # ファイルシステムの走査とソートは1回だけ実行し、結果をキャッシュする。
+        if self._all is None:
+            interpreters = list(self.find_all_cpython())
+            # interpreters += list(self.find_all_pypy())
+            # componentsタプル同士の比較はC実装で完結するため、Version.__lt__より速い。
+            interpreters.sort(key=operator.attrgetter('version.components'))
+            self._all = interpreters
+        return self._all
 
     def find_all_cpython(self):
-        pattern = self.prefix + '/Python-*/bin/python'
-        binaries = glob.glob(pattern)
-        for bin in binaries:
-            version_str = re.search(r'/Python-([^/]+)/', bin).group(1)
-            yield PythonInterpreter(
-                binary_path=bin,
-                bin_dir=os.path.dirname(bin),
-                version=Version(version_str),
-            )
+        # globはディレクトリ走査とfnmatchを内部で繰り返すため、scandirで1回だけ走査し、
+        # ディレクトリ名のスライスで直接バージョンを切り出す。
+        dir_prefix = 'Python-'
+        path_suffix = os.environ.get('PATH', '')
+        try:
+            entries = os.scandir(self.prefix)
+        except FileNotFoundError:
+            # glob.glob()と同様に、prefixが存在しないときは空の結果を返す。
+            return
+        with entries:
+            for entry in entries:
+                if not entry.name.startswith(dir_prefix):
+                    continue
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                bin_dir = os.path.join(entry.path, 'bin')
+                bin_path = os.path.join(bin_dir, 'python')
+                if not os.access(bin_path, os.X_OK):
+                    continue
+                yield PythonInterpreter(
+                    binary_path=bin_path,
+                    bin_dir=bin_dir,
+                    version=Version(entry.name[len(dir_prefix):]),
+                    path_env=bin_dir + ':' + path_suffix,
+                )
 
     def find_all_pypy(self):
         raise NotImplementedError()
 
 
+def _msg_digest(msg: str) -> bytes:
+    # 長大な出力同士の等価判定を16バイトのダイジェスト比較で済ませる。
+    return hashlib.blake2b(msg.encode('utf8', 'surrogatepass'), digest_size=16).digest()
+
+
 class SectionPrinter:
     def __init__(self, suppress_empty_msg=True, file=None):
         self.suppress_empty_msg = suppress_empty_msg
@@ -226,16 +418,19 @@ class SectionPrinter:
         if self.suppress_empty_msg and not msg:
             # msgが空なので、何も出力しない。
             return
-        file = self.file
-        end = None
-        if msg.endswith('\n'):
-            # msgが改行で終わっているときは、print()で改行を出力しないようにする。
-            end = ''
-
+        parts = []
         if self._need_section_gap:
-            print()
-        print(self._decorate_header(header), file=file)
-        print(msg, end=end, file=file)
+            parts.append('\n')
+        parts.append(self._decorate_header(header))
+        parts.append('\n')
+        parts.append(msg)
+        if not msg.endswith('\n'):
+            # msgが改行で終わっていないときだけ、改行を補う。
+            parts.append('\n')
+
+        # セクション全体を1回のwrite()にまとめて、システムコールの回数を抑える。
+        file = self.file or sys.stdout
+        file.write(''.join(parts))
         self._need_section_gap = True
 
     def _decorate_header(self, header: str) -> str:
@@ -267,26 +462,38 @@ class CompactSectionPrinter:
         self.first_header = None
         self.last_header = None
         self.previous_msg = None
+        self._previous_digest = None
 
     def _is_first(self) -> bool:
         return self.first_header is None
 
     def _is_omittable(self, msg: str) -> bool:
-        return self.previous_msg == msg
-
-    def _print(self):
+        prev = self.previous_msg
+        if prev is None or len(prev) != len(msg):
+            # 長さが一致しなければ内容も一致しないため、ダイジェスト計算を省略する。
+            return False
+        if self._previous_digest is None:
+            self._previous_digest = _msg_digest(prev)
+        return self._previous_digest == _msg_digest(msg)
+
+    def _print(self, msg: str):
         header = self.first_header
         if self.last_header:
             header = f'{self.first_header} ~ {self.last_header}'
-        self.p.print(header, self.previous_msg)
+        self.p.print(header, msg)
 
     def _update_section(self, header: Optional[str], out: Optional[str]):
         if not self._is_first():
-            self._print()
+            # 確定したセクションの本文への参照を出力前に手放し、新旧2つの本文を
+            # 出力中に同時に保持し続けないようにする。
+            msg, self.previous_msg = self.previous_msg, None
+            self._print(msg)
 
         self.first_header = header
         self.last_header = None
         self.previous_msg = out
+        # ダイジェストは_is_omittable()が必要になったときに計算する。
+        self._previous_digest = None
 
     def print(self, header: str, msg: str, file=None):
         if self._is_first() or not self._is_omittable(msg):
@@ -344,9 +551,9 @@ def parse_args():
                         metavar='CMD')
 
     # Optional: python interpreter versions
-    parser.add_argument('-s', '--min-version', type=Version, default=NullVersionMatcher(),
+    parser.add_argument('-s', '--min-version', type=MinVersionMatcher, default=NullVersionMatcher(),
                         help='minimum python version')
-    parser.add_argument('-e', '--max-version', type=Version, default=NullVersionMatcher(),
+    parser.add_argument('-e', '--max-version', type=MaxVersionMatcher, default=NullVersionMatcher(),
                         help='maximum python version')
     parser.add_argument('-v', '--version', type=MultiVersionMatcher, default=NullVersionMatcher(),
                         help='python versions')
@@ -391,40 +598,43 @@ def main():
 
         repo = PythonRepository(prefix='/opt/all-python')
 
-        def version_matcher(ver: Version) -> bool:
-            return (
-                    args.min_version.match(ver) and
-                    args.max_version.match(ver) and
-                    args.version.match(ver)
-            )
+        version_matcher = build_combined_matcher(args.min_version, args.max_version, args.version)
+
+        # サブプロセスの起動ごとにos.environを変換し直さないように、1回だけdictに変換する。
+        base_env = dict(os.environ)
 
         p = SectionPrinter()
-        p.print('before', args.before.run())
+        p.print('before', args.before.run(base_env=base_env))
 
-        csp = CompactSectionPrinter()
-        interpreters = repo.find(matcher=version_matcher)
-        for py in sorted(interpreters, key=lambda py: py.version):
-            if args.exec:
-                cmd = args.exec
-            elif args.python_args:
-                cmd = PythonCommand(args.python_args)
-            else:
-                raise Exception('bug: --exec and python_args are None')
+        if args.exec:
+            cmd = args.exec
+        elif args.python_args:
+            cmd = PythonCommand(args.python_args)
+        else:
+            raise Exception('bug: --exec and python_args are None')
 
+        def run_one(py: PythonInterpreter) -> str:
             try:
-                out = cmd.run(py)
+                return cmd.run(py, base_env=base_env)
             except subprocess.CalledProcessError as e:
                 # ignore error
                 stdout = e.stdout.rstrip('\n')
-                out = (
+                return (
                     f'{stdout}\n\n'
                     f'Command returned non-zero exit status {e.returncode}\n'
                     f'Command: {e.cmd}'
                 )
-            csp.print(str(py.version), out)
+
+        csp = CompactSectionPrinter()
+        interpreters = repo.sorted_find(version_matcher)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            # 各サブプロセスは独立しているため並列実行する。ただし、
+            # CompactSectionPrinterは入力の順序に依存するため、出力はソート順のまま行う。
+            for py, out in zip(interpreters, pool.map(run_one, interpreters)):
+                csp.print(str(py.version), out)
         csp.close()
 
-        p.print('after', args.after.run())
+        p.print('after', args.after.run(base_env=base_env))
         return 0
     except InvalidArgument as e:
         print('ERROR: ' + e.args[0], file=sys.stderr)